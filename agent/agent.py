@@ -2,12 +2,22 @@ import os
 import psutil
 import socket
 import json
+import ipaddress
 import threading
 import queue
+import time
 import requests
+from requests.adapters import HTTPAdapter
 import logging
-from datetime import datetime
-from scapy.all import sniff, TCP, UDP, IP, Ether
+import struct
+import orjson
+from scapy.all import conf, sniff, IP, Ether
+import capture
+import conntable
+from transport import UDPBatchSender
+
+# Prefer libpcap's native capture ring; Scapy falls back to its own sockets if unavailable
+conf.use_pcap = True
 
 # ---------------------------------------------------------
 # Logging Configuration
@@ -30,25 +40,69 @@ MANAGER_IP = os.getenv('MANAGER_IP', '127.0.0.1')
 MANAGER_PORT = int(os.getenv('MANAGER_PORT', 2053))
 SERVER_ADDRESS = (MANAGER_IP, MANAGER_PORT)
 
+# Kernel-level capture filter used when config.json does not provide one
+DEFAULT_SNIFF_FILTER = "ip and (tcp or udp)"
+
+# Geo-IP batch endpoint: up to 100 IPs per request, 15 requests per minute
+GEO_BATCH_URL = 'http://ip-api.com/batch?fields=status,country,query'
+GEO_BATCH_SIZE = 100
+GEO_BATCH_INTERVAL = 4
+
+# Network-order IPv4 address <-> uint32 conversion
+_U32 = struct.Struct('!I')
+_NO_MACS = bytes(12)
+_L4_PROTOCOLS = (6, 17)
+
+
+def ip_to_u32(ip_address):
+    return _U32.unpack(socket.inet_aton(ip_address))[0]
+
+
+def u32_to_ip(value):
+    return socket.inet_ntoa(_U32.pack(value))
+
 class NetworkAgent:
     """
     A distributed network agent responsible for sniffing, analyzing, 
     and reporting local traffic to a centralized Manager.
     """
     def __init__(self, config_path="config.json"):
-        # thread-safe queue to pass packets from sniffer to processor
+        # thread-safe queue to pass batches of decoded packet tuples from sniffer to processor
         self.packet_queue = queue.Queue()
         
         # UDP socket for high-performance, low-overhead data transmission
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # A 12 MB send buffer absorbs traffic bursts instead of dropping datagrams
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 12 * 1024 * 1024)
+        self.sender = UDPBatchSender(self.sock, SERVER_ADDRESS)
         self.my_ip = self.get_my_ip()
+        self.my_ip_u32 = ip_to_u32(self.my_ip)
+        self.settings = self.load_settings(config_path)
         
-        # Caching mechanisms to reduce API calls and system overhead
+        # Caching mechanisms to reduce API calls and system overhead.
+        # Keyed by the IPv4 address as a uint32, so lookups hash a plain int.
         self.country_cache = {}
-        self.software_cache = {}
+        # IPs awaiting a batched Geo-IP lookup
+        self._geo_queue = queue.Queue()
+        # Keep-alive HTTP session so batch lookups reuse one connection to the Geo-IP API
+        self._http = requests.Session()
+        self._http.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=4))
+        self._http.headers['User-Agent'] = 'traffix-agent'
+
+        # endpoint_key(ip, port) -> process name, rebuilt periodically and swapped in atomically
+        self._conn_table = conntable.snapshot_connections()
         
         logging.info(f"Agent initialized. Manager: {MANAGER_IP}:{MANAGER_PORT}, Local IP: {self.my_ip}")
 
+    def load_settings(self, config_path):
+        """Loads capture settings (interface, BPF filter) from the agent's config file."""
+        try:
+            with open(config_path, 'r') as f:
+                return json.load(f).get("settings", {})
+        except Exception as e:
+            logging.warning(f"Could not load {config_path}, using default capture settings. Error: {e}")
+            return {}
+
     def get_my_ip(self):
         """Retrieves the local primary IP address by simulating an external connection."""
         s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -63,71 +117,123 @@ class NetworkAgent:
             s.close()
         return my_ip
 
-    def get_country(self, ip_address):
-        """Performs a Geo-IP lookup with local caching for external destinations."""
-        if ip_address in self.country_cache:
-            return self.country_cache[ip_address]
+    def get_my_interface(self):
+        """Finds the network interface that owns the local primary IP address."""
+        for name, addresses in psutil.net_if_addrs().items():
+            if any(a.family == socket.AF_INET and a.address == self.my_ip for a in addresses):
+                return name
+        return None
+
+    def get_country(self, ip_u32):
+        """
+        Returns the cached Geo-IP country for a destination. Unknown public IPs are
+        queued for the batch lookup thread and reported as 'Unknown' meanwhile.
+        """
+        country = self.country_cache.get(ip_u32)
+        if country is not None:
+            # 'Pending' only de-duplicates queued lookups; it is never reported
+            return 'Unknown' if country == 'Pending' else country
 
         # Categorize private/local network segments
-        if ip_address.startswith('192.168.') or ip_address.startswith('10.') or ip_address.startswith('127.'):
-            self.country_cache[ip_address] = 'Local'
+        if ipaddress.IPv4Address(ip_u32).is_private:
+            self.country_cache[ip_u32] = 'Local'
             return 'Local'
 
-        try:
-            # Query external Geo-IP API
-            url = f'http://ip-api.com/json/{ip_address}?fields=status,country'
-            response = requests.get(url, timeout=2)
-            data = response.json()
-            country = data.get('country', 'Unknown') if data.get('status') == 'success' else 'Unknown'
-        except Exception as e:
-            logging.debug(f"Geo-IP lookup failed for {ip_address}: {e}")
-            country = 'Unknown'
+        self.country_cache[ip_u32] = 'Pending'
+        self._geo_queue.put(ip_u32)
+        return 'Unknown'
 
-        self.country_cache[ip_address] = country
-        return country
+    def geo_lookup_thread(self):
+        """Thread 4: Resolves queued IPs through the Geo-IP batch API, off the packet path."""
+        logging.info("Geo-IP lookup thread started...")
+        while True:
+            batch = [self._geo_queue.get()]
+            while len(batch) < GEO_BATCH_SIZE:
+                try:
+                    batch.append(self._geo_queue.get_nowait())
+                except queue.Empty:
+                    break
 
-    def get_software(self, ip, port):
-        """Maps a specific network connection to the local process name using psutil."""
-        address_key = f"{ip}:{port}"
-        if address_key in self.software_cache:
-            return self.software_cache[address_key]
+            try:
+                response = self._http.post(GEO_BATCH_URL, json=[u32_to_ip(ip_u32) for ip_u32 in batch], timeout=5)
+                results = response.json()
+                # Error responses come back as a single object rather than a list
+                countries = {r.get('query'): r.get('country', 'Unknown') for r in results
+                             if isinstance(r, dict) and r.get('status') == 'success'}
+            except Exception as e:
+                logging.debug(f"Geo-IP batch lookup failed for {len(batch)} IPs: {e}")
+                countries = {}
 
-        software_name = "Unknown"
-        try:
-            # Iterate through active system connections
-            connections = psutil.net_connections(kind='inet')
-            for conn in connections:
-                match_remote = conn.raddr and conn.raddr.ip == ip and conn.raddr.port == port
-                match_local = conn.laddr and conn.laddr.ip == ip and conn.laddr.port == port
-                
-                if (match_remote or match_local) and conn.pid:
-                    try:
-                        # Extract process name from PID
-                        process = psutil.Process(conn.pid)
-                        software_name = process.name()
-                        break
-                    except (psutil.NoSuchProcess, psutil.AccessDenied):
-                        pass
-        except Exception as e:
-            logging.debug(f"Process lookup error for {address_key}: {e}")
+            for ip_u32 in batch:
+                self.country_cache[ip_u32] = countries.get(u32_to_ip(ip_u32), 'Unknown')
+
+            # Stay within the API's rate limit
+            time.sleep(GEO_BATCH_INTERVAL)
 
-        self.software_cache[address_key] = software_name
-        return software_name
+    def get_software(self, ip_u32, port):
+        """Maps a specific network connection to the local process name via the connection table."""
+        return self._conn_table.get(conntable.endpoint_key(ip_u32, port), "Unknown")
 
-    def filter_packets(self, packet):
-        """LFilter: Ensures only IP packets with L4 protocols (TCP/UDP) are processed."""
-        return packet.haslayer(IP) and (packet.haslayer(TCP) or packet.haslayer(UDP))
+    def connection_refresh_thread(self, interval=0.5):
+        """Thread 3: Periodically snapshots the system's socket table for process mapping."""
+        logging.info("Connection table refresher started...")
+        while True:
+            time.sleep(interval)
+            self._conn_table = conntable.snapshot_connections()
 
     def packet_handler(self, packet):
-        """Queue producer: Hands off raw packets to the processing queue."""
-        self.packet_queue.put(packet)
+        """Queue producer: Reduces a Scapy packet to the fields the processor needs."""
+        # Custom sniff filters may let through non-TCP/UDP traffic or non-first fragments
+        if not packet.haslayer(IP):
+            return
+        ip_layer = packet[IP]
+        if ip_layer.proto not in _L4_PROTOCOLS or ip_layer.frag:
+            return
+
+        # Read the ports straight from the L4 header bytes instead of Scapy field access.
+        # This runs inside sniff(), so a truncated header must be skipped, never raised.
+        l4_header = bytes(ip_layer.payload)
+        if len(l4_header) < capture.PORTS.size:
+            return
+        sport, dport = capture.PORTS.unpack_from(l4_header)
+        macs = bytes(packet[Ether])[:12] if packet.haslayer(Ether) else _NO_MACS
+        self.packet_queue.put([(
+            ip_to_u32(ip_layer.src), ip_to_u32(ip_layer.dst), ip_layer.proto,
+            sport, dport, len(packet), macs
+        )])
 
     def sniffing_thread(self):
-        """Thread 1: Low-level packet capture using Scapy."""
+        """Thread 1: Low-level packet capture (AF_PACKET ring on Linux, Scapy elsewhere)."""
         logging.info(f"Sniffing thread started on {self.my_ip}...")
+        bpf_filter = self.settings.get("sniff_filter") or DEFAULT_SNIFF_FILTER
+        interface = self.settings.get("interface")
+
+        # The ring ships a precompiled BPF program, so custom filters stay on the Scapy path
+        if capture.is_supported() and bpf_filter == DEFAULT_SNIFF_FILTER:
+            ring_interface = interface or self.get_my_interface()
+            ring = None
+            if not capture.has_ethernet_header(ring_interface):
+                logging.warning(f"AF_PACKET ring needs an Ethernet interface, falling back to Scapy on {ring_interface}.")
+            else:
+                try:
+                    ring = capture.PacketRing(ring_interface)
+                except Exception as e:
+                    logging.warning(f"AF_PACKET ring unavailable, falling back to Scapy. Error: {e}")
+            if ring is not None:
+                try:
+                    # One queue hand-off per ring block rather than per packet
+                    for packets in ring.blocks():
+                        self.packet_queue.put(packets)
+                except Exception as e:
+                    logging.critical(f"Sniffing thread crashed: {e}")
+                finally:
+                    ring.close()
+                return
+
         try:
+            # The BPF filter is compiled into the kernel, so non-IP/TCP/UDP frames never reach Python.
             # store=0 prevents memory leaks during long-term monitoring
-            sniff(lfilter=self.filter_packets, prn=self.packet_handler, store=False)
+            sniff(filter=bpf_filter, iface=interface, prn=self.packet_handler, store=False)
         except Exception as e:
             logging.critical(f"Sniffing thread crashed: {e}")
 
@@ -135,50 +241,62 @@ class NetworkAgent:
         """Thread 2: Queue consumer: Analyzes, enriches, and ships data."""
         logging.info("Processing thread started...")
         while True:
-            packet = self.packet_queue.get()
             try:
-                ip_layer = packet[IP]
-                is_incoming = ip_layer.src != self.my_ip
-                
-                target_ip = ip_layer.src if is_incoming else ip_layer.dst
-                mac_addr = packet[Ether].src if is_incoming else packet[Ether].dst
-                
-                # Determine port based on the active L4 layer
-                if packet.haslayer(TCP):
-                    port = packet[TCP].sport if is_incoming else packet[TCP].dport
-                else:
-                    port = packet[UDP].sport if is_incoming else packet[UDP].dport
-
-                # Construct JSON telemetry for the Manager
-                payload = {
-                    "timestamp": datetime.now().isoformat(),
-                    "direction": "in" if is_incoming else "out",
-                    "destination_ip": target_ip,
-                    "port": port,
-                    "size_bytes": len(packet),
-                    "country": self.get_country(target_ip),
-                    "software_name": self.get_software(target_ip, port),
-                    "mac": mac_addr
-                }
-
-                # Encode and transmit via UDP
-                json_data = json.dumps(payload).encode('utf-8')
-                self.sock.sendto(json_data, SERVER_ADDRESS)
-                logging.debug(f"Sent: {payload['software_name']} to {target_ip}")
-                
-            except Exception as e:
-                logging.error(f"Error processing packet: {e}")
+                # Wake up in time to flush a partially filled batch when traffic goes quiet
+                packets = self.packet_queue.get(timeout=self.sender.flush_interval if self.sender.pending else None)
+            except queue.Empty:
+                self.sender.flush()
+                continue
+
+            try:
+                for packet in packets:
+                    self.process_packet(packet)
             finally:
                 # Cleanup: ensure queue tracking remains accurate
                 self.packet_queue.task_done()
 
+    def process_packet(self, packet):
+        """Enriches one decoded packet tuple and queues its telemetry for the Manager."""
+        src_ip, dst_ip, proto, sport, dport, length, macs = packet
+        try:
+            is_incoming = src_ip != self.my_ip_u32
+            
+            target_u32 = src_ip if is_incoming else dst_ip
+            target_ip = u32_to_ip(target_u32)
+            mac_addr = (macs[6:12] if is_incoming else macs[:6]).hex(':')
+            port = sport if is_incoming else dport
+
+            # Construct JSON telemetry for the Manager
+            payload = {
+                "ts_ns": time.time_ns(),
+                "direction": "in" if is_incoming else "out",
+                "destination_ip": target_ip,
+                "port": port,
+                "size_bytes": length,
+                "country": self.get_country(target_u32),
+                "software_name": self.get_software(target_u32, port),
+                "mac": mac_addr
+            }
+
+            # Encode and queue for batched UDP transmission
+            json_data = orjson.dumps(payload)
+            self.sender.send(json_data)
+            logging.debug(f"Queued: {payload['software_name']} to {target_ip}")
+            
+        except Exception as e:
+            logging.error(f"Error processing packet: {e}")
+
     def run(self):
         """Initialize and manage lifecycle of parallel monitoring threads."""
         t1 = threading.Thread(target=self.sniffing_thread, daemon=True)
         t2 = threading.Thread(target=self.processing_thread, daemon=True)
+        t3 = threading.Thread(target=self.connection_refresh_thread, daemon=True)
+        t4 = threading.Thread(target=self.geo_lookup_thread, daemon=True)
         
         t1.start()
         t2.start()
+        t3.start()
+        t4.start()
         
         try:
             while True:
@@ -187,6 +305,5 @@ class NetworkAgent:
             logging.info("Agent stopped by user.")
 
 if __name__ == "__main__":
-    import time
     agent = NetworkAgent()
     agent.run()
\ No newline at end of file
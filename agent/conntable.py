@@ -0,0 +1,126 @@
+import logging
+import os
+import socket
+import struct
+import psutil
+
+# Kernel socket tables scanned on Linux hosts
+PROC_NET_TABLES = ("tcp", "tcp6", "udp", "udp6")
+_V4_MAPPED_WORD = b'\x00\x00\xff\xff'
+_HOST_U32 = struct.Struct('=I')
+_NET_U32 = struct.Struct('!I')
+
+
+def endpoint_key(ip_u32, port):
+    """Packs an IPv4 address (network-order uint32) and port into one integer key."""
+    return (ip_u32 << 16) | port
+
+
+def _decode_v4(hex_addr):
+    """/proc/net stores IPv4 addresses as a host-order 32-bit hex word."""
+    return _NET_U32.unpack(_HOST_U32.pack(int(hex_addr, 16)))[0]
+
+
+def _decode_v6(hex_addr):
+    """
+    IPv6 addresses are four host-order words. Only IPv4-mapped ones can match
+    captured (IPv4) traffic; the rest decode to None.
+    """
+    if int(hex_addr[:16], 16) or _HOST_U32.pack(int(hex_addr[16:24], 16)) != _V4_MAPPED_WORD:
+        return None
+    return _decode_v4(hex_addr[24:])
+
+
+def _socket_owners():
+    """Maps socket inodes to process names by resolving every /proc/<pid>/fd link."""
+    owners = {}
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            fds = os.listdir(f'/proc/{pid}/fd')
+        except OSError:
+            continue
+
+        name = None
+        for fd in fds:
+            try:
+                link = os.readlink(f'/proc/{pid}/fd/{fd}')
+            except OSError:
+                continue
+            if not link.startswith('socket:['):
+                continue
+            if name is None:
+                try:
+                    with open(f'/proc/{pid}/comm') as f:
+                        name = f.read().strip()
+                except OSError:
+                    break
+            owners[link[8:-1]] = name
+    return owners
+
+
+def _snapshot_proc():
+    """Builds the connection table straight from /proc/net/{tcp,udp}[6]."""
+    owners = _socket_owners()
+    table = {}
+    for kind in PROC_NET_TABLES:
+        decode = _decode_v6 if kind.endswith('6') else _decode_v4
+        try:
+            f = open(f'/proc/net/{kind}')
+        except OSError:
+            continue
+        with f:
+            next(f, None)  # header row
+            for line in f:
+                # sl local_address rem_address st tx:rx tr:when retrnsmt uid timeout inode ...
+                fields = line.split()
+                name = owners.get(fields[9])
+                if name is None:
+                    continue
+                for address in (fields[1], fields[2]):
+                    ip_hex, port_hex = address.split(':')
+                    ip_u32, port = decode(ip_hex), int(port_hex, 16)
+                    if ip_u32 is not None and port:
+                        table[endpoint_key(ip_u32, port)] = name
+    return table
+
+
+def _snapshot_psutil():
+    """Portable fallback for hosts without a /proc filesystem."""
+    names = {}
+    table = {}
+    for conn in psutil.net_connections(kind='inet'):
+        if not conn.pid:
+            continue
+        if conn.pid not in names:
+            try:
+                names[conn.pid] = psutil.Process(conn.pid).name()
+            except (psutil.NoSuchProcess, psutil.AccessDenied):
+                names[conn.pid] = None
+        if names[conn.pid] is None:
+            continue
+        for address in (conn.laddr, conn.raddr):
+            if not address:
+                continue
+            ip = address.ip[7:] if address.ip.startswith('::ffff:') else address.ip
+            try:
+                ip_u32 = _NET_U32.unpack(socket.inet_aton(ip))[0]
+            except OSError:
+                continue  # IPv6 endpoints never match captured IPv4 traffic
+            table[endpoint_key(ip_u32, address.port)] = names[conn.pid]
+    return table
+
+
+def snapshot_connections():
+    """
+    Returns an {endpoint_key(ip, port): process_name} table covering both
+    ends of every IPv4 socket currently owned by a local process.
+    """
+    try:
+        if os.path.exists('/proc/net/tcp'):
+            return _snapshot_proc()
+        return _snapshot_psutil()
+    except Exception as e:
+        logging.debug(f"Connection table snapshot failed: {e}")
+        return {}
@@ -0,0 +1,145 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import socket
+import struct
+import sys
+import time
+
+# Scratch slot reserved per queued datagram; telemetry payloads are a few hundred bytes
+SLOT_SIZE = 2048
+
+
+# ---------------------------------------------------------
+# libc sendmmsg(2) bindings (see <sys/socket.h>)
+# ---------------------------------------------------------
+class IOVec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+
+class MsgHdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_name", ctypes.c_void_p), ("msg_namelen", ctypes.c_uint32),
+        ("msg_iov", ctypes.POINTER(IOVec)), ("msg_iovlen", ctypes.c_size_t),
+        ("msg_control", ctypes.c_void_p), ("msg_controllen", ctypes.c_size_t),
+        ("msg_flags", ctypes.c_int),
+    ]
+
+
+class MMsgHdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", MsgHdr), ("msg_len", ctypes.c_uint)]
+
+
+def _load_sendmmsg():
+    """Returns libc's sendmmsg, or None on platforms that do not provide it."""
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        sendmmsg = libc.sendmmsg
+    except (OSError, AttributeError):
+        return None
+    sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(MMsgHdr), ctypes.c_uint, ctypes.c_int]
+    sendmmsg.restype = ctypes.c_int
+    return sendmmsg
+
+
+class UDPBatchSender:
+    """
+    Coalesces telemetry datagrams and ships each batch with a single
+    sendmmsg(2) call. Falls back to one sendto() per datagram elsewhere.
+    """
+    def __init__(self, sock, address, batch_size=32, flush_interval=0.005, slot_size=SLOT_SIZE):
+        self.sock = sock
+        self.address = address
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.slot_size = slot_size
+
+        self._count = 0
+        self._first_queued = 0.0
+        self._sendmmsg = _load_sendmmsg()
+
+        # Scratch arena with one fixed slot per batch entry, reused by every batch.
+        # Each iovec points at its slot permanently, so queuing a datagram is a
+        # slice copy plus a length update.
+        self._arena = bytearray(batch_size * slot_size)
+        self._view = memoryview(self._arena)
+        base = ctypes.addressof((ctypes.c_char * len(self._arena)).from_buffer(self._arena))
+        self._iovs = (IOVec * batch_size)()
+        for i, iov in enumerate(self._iovs):
+            iov.iov_base = base + i * slot_size
+
+        if self._sendmmsg:
+            host, port = address
+            try:
+                packed_ip = socket.inet_aton(socket.gethostbyname(host))
+            except OSError as e:
+                # sendto() resolves the name on every send, so delivery starts once it resolves
+                logging.error(f"Could not resolve manager address {host}, falling back to sendto. Error: {e}")
+                self._sendmmsg = None
+
+        if self._sendmmsg:
+            # struct sockaddr_in, built once and shared by every message header
+            sockaddr = struct.pack('=H', socket.AF_INET) + struct.pack('!H', port) + packed_ip + bytes(8)
+            self._sockaddr = ctypes.create_string_buffer(sockaddr, len(sockaddr))
+
+            # Message headers are registered once: each points at its own iovec and the
+            # shared address, so a flush submits them as they are.
+            self._msgs = (MMsgHdr * batch_size)()
+            for iov, msg in zip(self._iovs, self._msgs):
+                msg.msg_hdr.msg_name = ctypes.addressof(self._sockaddr)
+                msg.msg_hdr.msg_namelen = ctypes.sizeof(self._sockaddr)
+                msg.msg_hdr.msg_iov = ctypes.pointer(iov)
+                msg.msg_hdr.msg_iovlen = 1
+
+    @property
+    def pending(self):
+        return self._count
+
+    def send(self, data):
+        """Queues one datagram, flushing when the batch is full or has waited too long."""
+        size = len(data)
+        if size > self.slot_size:
+            # Too large for a scratch slot: keep ordering and send it on its own
+            self.flush()
+            self._sendto(data)
+            return
+
+        if not self._count:
+            self._first_queued = time.monotonic()
+        offset = self._count * self.slot_size
+        self._arena[offset:offset + size] = data
+        self._iovs[self._count].iov_len = size
+        self._count += 1
+
+        if self._count >= self.batch_size or time.monotonic() - self._first_queued >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """Transmits every queued datagram."""
+        n, self._count = self._count, 0
+        if not n:
+            return
+
+        if not self._sendmmsg:
+            for i in range(n):
+                offset = i * self.slot_size
+                self._sendto(self._view[offset:offset + self._iovs[i].iov_len])
+            return
+
+        # sendmmsg may transmit only part of the batch; resubmit the remainder
+        sent = 0
+        while sent < n:
+            result = self._sendmmsg(self.sock.fileno(), ctypes.byref(self._msgs[sent]), n - sent, 0)
+            if result < 0:
+                logging.debug(f"sendmmsg failed, dropping {n - sent} datagrams: {os.strerror(ctypes.get_errno())}")
+                return
+            sent += result
+
+    def _sendto(self, data):
+        try:
+            self.sock.sendto(data, self.address)
+        except OSError as e:
+            logging.debug(f"sendto failed, dropping datagram: {e}")
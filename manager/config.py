@@ -1,69 +1,132 @@
+import ipaddress
 import json
 import os
+import threading
+import time
 
 # Define the path to our configuration file
 CONFIG_FILE = "config.json"
 
+# How often (seconds) the background watcher checks the config file for changes
+RELOAD_INTERVAL = 1.0
+
 class ConfigManager:
     """
     Manages system configurations with support for dynamic on-the-fly reloading.
+    A background watcher picks up file changes, so getters never touch the disk.
     """
-    def __init__(self, config_path=CONFIG_FILE):
+    def __init__(self, config_path=CONFIG_FILE, reload_interval=RELOAD_INTERVAL):
         self.config_path = config_path
         self._last_mtime = 0 # Track file modification time for performance
         self._config_cache = {}
+        self._blacklist_set = frozenset()
+        self._blacklist_cidrs = {}
+        self._lock = threading.Lock()
         self.load_config()
 
+        # Polling (rather than inotify) works on every platform and survives editors
+        # that save by replacing the file.
+        threading.Thread(target=self._watch, args=(reload_interval,), daemon=True).start()
+
+    def _watch(self, interval):
+        """Watcher thread: re-checks the config file's mtime once per interval."""
+        while True:
+            time.sleep(interval)
+            self.load_config()
+
     def load_config(self):
         """
         Loads the JSON config file from disk.
         Implements a 'lazy read' strategy: only reads if the file was modified.
         """
-        if not os.path.exists(self.config_path):
-            print(f"[!] Warning: Configuration file {self.config_path} not found.")
-            # Critical: Provide hardcoded defaults if the file is missing
-            self._config_cache = {
-                "server": {"host": "127.0.0.1", "port": 2053},
-                "security": {"blacklist_ips": []}
-            }
-            return
+        with self._lock:
+            if not os.path.exists(self.config_path):
+                # Warn once per disappearance; -1 makes the file's return count as a change
+                if self._last_mtime != -1:
+                    print(f"[!] Warning: Configuration file {self.config_path} not found.")
+                    self._last_mtime = -1
+                # Critical: Provide hardcoded defaults if the file is missing
+                self._apply({
+                    "server": {"host": "127.0.0.1", "port": 2053},
+                    "security": {"blacklist_ips": []}
+                })
+                return
 
-        try:
-            # Check the "Modified Time" (mtime) from the OS metadata
-            current_mtime = os.path.getmtime(self.config_path)
-            
-            # Hot-reloading: reload data only if the file timestamp has changed
-            if current_mtime > self._last_mtime:
-                with open(self.config_path, 'r') as f:
-                    self._config_cache = json.load(f)
-                self._last_mtime = current_mtime
-                print("[*] Configuration reloaded successfully from disk.")
-                
-        except Exception as e:
-            # Fallback to current cache if a reload fails (e.g., during a manual edit)
-            print(f"[!] Error loading config file: {e}")
+            try:
+                # Check the "Modified Time" (mtime) from the OS metadata
+                current_mtime = os.path.getmtime(self.config_path)
+
+                # Hot-reloading: reload data only if the file timestamp has changed
+                if current_mtime > self._last_mtime:
+                    with open(self.config_path, 'r') as f:
+                        self._apply(json.load(f))
+                    self._last_mtime = current_mtime
+                    print("[*] Configuration reloaded successfully from disk.")
+
+            except Exception as e:
+                # Fallback to current cache if a reload fails (e.g., during a manual edit)
+                print(f"[!] Error loading config file: {e}")
+
+    def _apply(self, config_data):
+        """Swaps in a freshly loaded config and precomputes its lookup structures."""
+        exact = set()
+        # ip version -> {prefix length: set of network prefixes}
+        cidrs = {4: {}, 6: {}}
+        for entry in config_data.get("security", {}).get("blacklist_ips", []):
+            if "/" not in entry:
+                exact.add(entry)
+                continue
+            try:
+                network = ipaddress.ip_network(entry, strict=False)
+            except ValueError:
+                print(f"[!] Ignoring invalid blacklist entry: {entry}")
+                continue
+            shift = network.max_prefixlen - network.prefixlen
+            cidrs[network.version].setdefault(shift, set()).add(int(network.network_address) >> shift)
+
+        self._blacklist_set = frozenset(exact)
+        self._blacklist_cidrs = {
+            version: tuple((shift, frozenset(prefixes)) for shift, prefixes in by_shift.items())
+            for version, by_shift in cidrs.items() if by_shift
+        }
+        self._config_cache = config_data
 
     def get_blacklist(self):
         """
-        Retrieves the latest blacklist of suspicious IP addresses.
-        Triggers an mtime check to ensure fresh data.
+        Retrieves the latest blacklist of exact suspicious IP addresses
+        as a frozenset for O(1) membership tests.
         """
-        self.load_config() 
-        return self._config_cache.get("security", {}).get("blacklist_ips", [])
+        return self._blacklist_set
+
+    def is_blacklisted(self, ip_address):
+        """
+        Checks an IP against both exact blacklist entries and CIDR ranges.
+        Ranges are grouped by prefix length, so the cost is one set lookup per
+        distinct prefix length, regardless of how many ranges are listed.
+        """
+        if ip_address in self._blacklist_set:
+            return True
+        # Skip address parsing entirely when no ranges are configured
+        if not self._blacklist_cidrs:
+            return False
+        try:
+            address = ipaddress.ip_address(ip_address)
+        except ValueError:
+            return False
+        value = int(address)
+        return any(value >> shift in prefixes for shift, prefixes in self._blacklist_cidrs.get(address.version, ()))
 
     def get_server_settings(self):
         """
         Retrieves network parameters (Host/Port) for the UDP listener.
         """
-        self.load_config()
         server_config = self._config_cache.get("server", {})
         return server_config.get("host", "127.0.0.1"), server_config.get("port", 2053)
-    
+
     def get_agent_name(self, ip_address):
         """Returns a friendly name for an IP if defined in config, else returns a default name."""
-        self.load_config()
         names = self._config_cache.get("agent_names", {})
         return names.get(ip_address, f"Agent_{ip_address}")
 
 # Global singleton instance for the Manager to import
-config = ConfigManager()
\ No newline at end of file
+config = ConfigManager()
@@ -1,5 +1,5 @@
 from datetime import datetime, timezone
-from sqlalchemy import BigInteger, create_engine, Column, Integer, String, DateTime, ForeignKey
+from sqlalchemy import BigInteger, create_engine, Column, Integer, String, DateTime, ForeignKey, Index, text
 from sqlalchemy.orm import declarative_base, relationship, sessionmaker
 import os
 from dotenv import load_dotenv
@@ -22,6 +22,9 @@ SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 # Base class for all SQLAlchemy models
 Base = declarative_base()
 
+# Width of a traffic_rollups time bucket (5 minutes)
+ROLLUP_BUCKET_SECONDS = 300
+
 # ---------------------------------------------------------
 # Database Models (Tables)
 # ---------------------------------------------------------
@@ -49,8 +52,8 @@ class TrafficLog(Base):
     # Foreign key linking back to the originating agent
     agent_id = Column(Integer, ForeignKey("agents.id"), index=True) 
     
-    # CRITICAL: Descending index on timestamp to speed up dashboard timeframe filtering
-    timestamp = Column(DateTime, default=lambda: datetime.now(timezone.utc), index=True)
+    # Indexed below: (agent_id, timestamp DESC) btree plus a BRIN for time-range scans
+    timestamp = Column(DateTime, default=lambda: datetime.now(timezone.utc))
     direction = Column(String)
     
     # Indexed fields to optimize 'Top 10' aggregations (IPs, Countries, Softwares)
@@ -66,6 +69,14 @@ class TrafficLog(Base):
     # Link to parent Agent object
     agent = relationship("Agent", back_populates="traffic_logs")
 
+    __table_args__ = (
+        # Per-agent timeframe filters, newest first
+        Index("ix_tl_agent_time", "agent_id", timestamp.desc()),
+        # Rows arrive in time order, so a tiny BRIN covers all-agent time ranges
+        # without the write amplification of a full btree
+        Index("ix_tl_ts_brin", "timestamp", postgresql_using="brin", postgresql_with={"pages_per_range": 32}),
+    )
+
 
 class BlacklistAlert(Base):
     """Security-focused table to record specific policy violations."""
@@ -80,10 +91,60 @@ class BlacklistAlert(Base):
     # Link back to the compromised/monitoring agent
     agent = relationship("Agent", back_populates="alerts")
 
+class TrafficRollup(Base):
+    """
+    Pre-aggregated packet and byte counters per agent, 5-minute bucket and label.
+    Maintained incrementally by the Manager's bulk writer so the dashboard
+    never has to scan traffic_logs.
+    """
+    __tablename__ = "traffic_rollups"
+
+    agent_id = Column(Integer, ForeignKey("agents.id"), primary_key=True)
+    
+    # Which traffic_logs column is aggregated: 'country', 'software' or 'ip'
+    dimension = Column(String, primary_key=True)
+    bucket = Column(DateTime, primary_key=True)
+    label = Column(String, primary_key=True)
+
+    packets = Column(BigInteger, nullable=False, default=0)
+    bytes = Column(BigInteger, nullable=False, default=0)
+
+    # The primary key serves per-agent stats; this serves the 'all agents' view
+    __table_args__ = (Index("ix_rollup_dimension_bucket", "dimension", "bucket"),)
+
 # ---------------------------------------------------------
 # Schema Initialization
 # ---------------------------------------------------------
 
+# Maps each rollup dimension to its source column in traffic_logs
+ROLLUP_SOURCES = {"country": "country", "software": "software_name", "ip": "destination_ip"}
+
+def ensure_indexes():
+    """Brings indexes of pre-existing tables up to date (create_all only indexes new tables)."""
+    with engine.begin() as conn:
+        # Superseded by ix_tl_agent_time and ix_tl_ts_brin
+        conn.execute(text("DROP INDEX IF EXISTS ix_traffic_logs_timestamp"))
+    for table in (TrafficLog.__table__, TrafficRollup.__table__):
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
+
+def backfill_rollups():
+    """Builds traffic_rollups from existing traffic_logs when the rollup table is still empty."""
+    with engine.begin() as conn:
+        if conn.execute(text("SELECT 1 FROM traffic_rollups LIMIT 1")).first():
+            return
+        for dimension, column in ROLLUP_SOURCES.items():
+            conn.execute(text(f"""
+                INSERT INTO traffic_rollups (agent_id, dimension, bucket, label, packets, bytes)
+                SELECT agent_id, :dimension,
+                       to_timestamp(floor(extract(epoch FROM timestamp) / :width) * :width) AT TIME ZONE 'UTC',
+                       COALESCE({column}, 'Unknown'), count(*), COALESCE(sum(size_bytes), 0)
+                FROM traffic_logs
+                WHERE agent_id IS NOT NULL
+                GROUP BY 1, 2, 3, 4
+            """), {"dimension": dimension, "width": ROLLUP_BUCKET_SECONDS})
+
+
 if __name__ == "__main__":
     try:
         print("Starting the database connection...")
@@ -96,6 +157,10 @@ if __name__ == "__main__":
         Base.metadata.create_all(bind=engine)
         print("SUCCESS: Tables were created (or verified) successfully!")
         
+        # Upgrade indexes and aggregate any traffic logged before the rollup table existed
+        ensure_indexes()
+        backfill_rollups()
+        
         # Inspect existing schema to verify tables exist in PostgreSQL
         from sqlalchemy import inspect
         inspector = inspect(engine)
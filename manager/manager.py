@@ -1,28 +1,73 @@
-import json
-import socketserver
+import orjson
+import socket
+import csv
+import io
+import queue
 import sys
 import threading
 import asyncio
 import time
 from fastapi.staticfiles import StaticFiles
 import os
-from database import engine, Base
+from database import engine, Base, backfill_rollups, ensure_indexes
 from datetime import datetime, timedelta, timezone
 from contextlib import asynccontextmanager
 from collections import defaultdict
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
 from sqlalchemy import func, text
-from database import SessionLocal, Agent, TrafficLog, BlacklistAlert
+from psycopg2.extras import execute_values
+from database import SessionLocal, Agent, BlacklistAlert, TrafficRollup, ROLLUP_BUCKET_SECONDS
 from config import config
 
 # --- Global Locks and State ---
-# This lock prevents race conditions between the Agent's INSERTs and the Admin's RESET
+# This lock prevents race conditions between the bulk writer's COPYs / agent registration and the Admin's RESET
 db_lock = threading.Lock()
+# Bumped (under db_lock) by every Reset. Queued rows and alerts carry the generation
+# their agent id was resolved in, and are discarded if a Reset has happened since.
+db_generation = 0
 
-active_connections = []
-port_scan_tracker = defaultdict(set)
-last_alert_time = {}
+# Traffic rows waiting to be bulk-copied into PostgreSQL by the writer thread.
+# Bounded so that a slow or unreachable DB drops rows instead of exhausting memory.
+WRITER_QUEUE_SIZE = 100000
+pending_logs = queue.Queue(maxsize=WRITER_QUEUE_SIZE)
+WRITER_BATCH_SIZE = 1000
+WRITER_FLUSH_INTERVAL = 0.05
+TRAFFIC_LOG_COPY = (
+    "COPY traffic_logs (agent_id, timestamp, direction, destination_ip, port, size_bytes, country, software_name) "
+    "FROM STDIN WITH (FORMAT csv)"
+)
+TRAFFIC_ROLLUP_UPSERT = (
+    "INSERT INTO traffic_rollups (agent_id, dimension, bucket, label, packets, bytes) VALUES %s "
+    "ON CONFLICT (agent_id, dimension, bucket, label) DO UPDATE SET "
+    "packets = traffic_rollups.packets + EXCLUDED.packets, bytes = traffic_rollups.bytes + EXCLUDED.bytes"
+)
+
+# Kernel receive buffer for each UDP socket; Linux caps it at net.core.rmem_max
+UDP_RCVBUF_BYTES = 12 * 1024 * 1024
+UDP_MAX_DATAGRAM = 65535
+
+# Linux load-balances SO_REUSEPORT sockets by 4-tuple, so each worker sees a stable
+# subset of agents. Other platforms deliver to a single socket, so run one worker there.
+UDP_WORKERS = (os.cpu_count() or 1) if sys.platform.startswith("linux") else 1
+
+# agent ip -> agent id, so the agents table is only consulted once per agent
+agent_id_cache = {}
+# Registers an agent or returns the existing row's id in a single round-trip
+AGENT_UPSERT = text(
+    "INSERT INTO agents (ip_address, mac_address, name) VALUES (:ip, :mac, :name) "
+    "ON CONFLICT (ip_address) DO UPDATE SET ip_address = EXCLUDED.ip_address RETURNING id"
+)
+
+# WebSocket -> its bounded outgoing message queue, drained by a per-client writer task
+active_connections = {}
+WS_QUEUE_SIZE = 1024
+
+# Per (agent, target) port tracking starts as a small set; targets that see more
+# than PORT_SET_LIMIT distinct ports are promoted to a bitmap of all 65536 ports
+PORT_SET_LIMIT = 8
+PORT_MAP_BYTES = 65536 // 8
+# Each UDP worker owns one port scan detector and only ever sees its own agents
 SCAN_THRESHOLD = 20
 SCAN_WINDOW = 60
 main_loop = None
@@ -32,8 +77,13 @@ main_loop = None
 async def lifespan(app: FastAPI):
     # Ensure tables exist on startup
     Base.metadata.create_all(bind=engine)
+    ensure_indexes()
+    backfill_rollups()
     global main_loop
     main_loop = asyncio.get_running_loop()
+    # Ingestion starts only once the schema and rollup backfill are in place,
+    # so live batches never race the backfill's empty-table check or inserts
+    start_ingestion()
     yield
 
 app = FastAPI(lifespan=lifespan)
@@ -50,84 +100,297 @@ app.add_middleware(
 dashboard_path = os.path.join(os.path.dirname(__file__), "../dashboard")
 app.mount("/dashboard", StaticFiles(directory=dashboard_path, html=True), name="dashboard")
 
-async def broadcast_packet(packet_data):
-    """Push real-time updates to all connected WebSocket clients."""
-    if not active_connections:
-        return
-    for connection in list(active_connections):
+def broadcast_packet(message):
+    """
+    Push a real-time update (pre-encoded JSON text) to every connected client's queue.
+    Runs on the event loop; a client whose queue is full misses the update instead
+    of stalling everyone else.
+    """
+    for outbox in active_connections.values():
         try:
-            await connection.send_json(packet_data)
-        except Exception:
-            if connection in active_connections:
-                active_connections.remove(connection)
-
-def detect_port_scan(agent_ip, target_ip, port):
-    """Heuristic logic to identify sequential port scanning behavior."""
-    key = (agent_ip, target_ip)
-    port_scan_tracker[key].add(port)
-    
-    if len(port_scan_tracker[key]) > SCAN_THRESHOLD:
-        now = time.time()
-        if key not in last_alert_time or now - last_alert_time[key] > SCAN_WINDOW:
-            last_alert_time[key] = now
-            port_scan_tracker[key] = set() 
-            return True
-    return False
-
-class UDPDataHandler(socketserver.BaseRequestHandler):
-    """Backend handler for raw UDP data sent by network agents."""
-    def handle(self):
-        raw_data = self.request[0].strip()
-        agent_ip = self.client_address[0]
+            outbox.put_nowait(message)
+        except asyncio.QueueFull:
+            pass
+
+async def websocket_writer(websocket: WebSocket, outbox: asyncio.Queue):
+    """Drains one client's queue onto its socket until the connection fails."""
+    try:
+        while True:
+            await websocket.send_text(await outbox.get())
+    except Exception:
+        pass
+
+class PortScanDetector:
+    """
+    Tracks the distinct ports each agent touches per target. Every UDP worker owns
+    its own detector and is the only thread that touches it: a Reset is picked up
+    through the db generation (see sync) rather than cleared from another thread.
+    """
+    def __init__(self):
+        # db generation this state belongs to
+        self.generation = db_generation
+        # (agent, target) -> set of ports, or a bytearray bitmap once promoted
+        self.port_maps = {}
+        # Distinct-port counts for promoted bitmaps (sets know their own size)
+        self.counts = {}
+        self.last_alert_time = {}
+
+    def detect(self, agent_ip, target_ip, port):
+        """Heuristic logic to identify sequential port scanning behavior."""
+        if port is None:
+            return False
+        key = (agent_ip, target_ip)
+        ports = self.port_maps.get(key)
+
+        if ports is None:
+            self.port_maps[key] = {port}
+            return False
+
+        if isinstance(ports, set):
+            if port in ports:
+                return False
+            ports.add(port)
+            count = len(ports)
+            if count > PORT_SET_LIMIT:
+                # Past a handful of ports a fixed 8 KB bitmap beats a growing set
+                port_map = bytearray(PORT_MAP_BYTES)
+                for p in ports:
+                    port_map[p >> 3] |= 1 << (p & 7)
+                self.port_maps[key] = port_map
+                self.counts[key] = count
+        else:
+            index, mask = port >> 3, 1 << (port & 7)
+            if ports[index] & mask:
+                return False
+            ports[index] |= mask
+            count = self.counts[key] = self.counts[key] + 1
+        
+        if count > SCAN_THRESHOLD:
+            now = time.time()
+            if key not in self.last_alert_time or now - self.last_alert_time[key] > SCAN_WINDOW:
+                self.last_alert_time[key] = now
+                # Start over with a fresh set, releasing the bitmap
+                del self.port_maps[key]
+                self.counts.pop(key, None)
+                return True
+        return False
+
+    def sync(self, generation):
+        """Drops all tracked state once the owning worker sees a post-Reset generation."""
+        if generation > self.generation:
+            self.generation = generation
+            self.port_maps.clear()
+            self.counts.clear()
+            self.last_alert_time.clear()
+
+def resolve_agent_id(agent_ip, mac_address):
+    """
+    Returns (agent id, db generation), registering the agent on first sight.
+    The generation is read before the cache: the Reset clears the cache before
+    bumping it, so a stale id is always paired with a stale generation.
+    """
+    generation = db_generation
+    agent_id = agent_id_cache.get(agent_ip)
+    if agent_id is not None:
+        return agent_id, generation
+
+    # Serialize with the Reset so a freshly truncated table is never paired with a stale cache
+    with db_lock:
+        db = SessionLocal()
         try:
-            payload = json.loads(raw_data.decode('utf-8'))
-        except: return
+            worker_name = config.get_agent_name(agent_ip)
+            agent_id = db.execute(AGENT_UPSERT, {"ip": agent_ip, "mac": mac_address, "name": f"Agent_{worker_name}"}).scalar()
+            db.commit()
+            agent_id_cache[agent_ip] = agent_id
+            return agent_id, db_generation
+        finally:
+            db.close()
 
-        # Synchronize DB access to avoid UniqueViolation during Reset
-        with db_lock:
-            db = SessionLocal()
+def rollup_bucket(ts):
+    """Floors a UTC timestamp to the start of its rollup bucket (naive UTC, like the column)."""
+    epoch = int(ts.timestamp()) // ROLLUP_BUCKET_SECONDS * ROLLUP_BUCKET_SECONDS
+    return datetime.fromtimestamp(epoch, timezone.utc).replace(tzinfo=None)
+
+def aggregate_rollups(rows):
+    """Folds a batch of traffic rows into per-(agent, dimension, bucket, label) counters."""
+    totals = defaultdict(lambda: [0, 0])
+    for agent_id, ts, _, target_ip, _, size, country, software in rows:
+        bucket = rollup_bucket(ts)
+        for dimension, label in (("country", country), ("software", software), ("ip", target_ip)):
+            counters = totals[(agent_id, dimension, bucket, label or "Unknown")]
+            counters[0] += 1
+            counters[1] += size or 0
+    return [key + tuple(counters) for key, counters in totals.items()]
+
+def copy_traffic_logs(batch):
+    """Bulk-loads a batch of (generation, row) items with a single COPY FROM STDIN and updates the rollups."""
+    with db_lock:
+        # Rows resolved before a Reset reference truncated (or since reused) agent ids
+        rows = [row for generation, row in batch if generation == db_generation]
+        if not rows:
+            return
+        conn = None
+        try:
+            buf = io.StringIO()
+            csv.writer(buf).writerows(rows)
+            buf.seek(0)
+            rollups = aggregate_rollups(rows)
+            # Checkout is inside the guard: a stale pooled connection must not escape
+            conn = engine.raw_connection()
+            cursor = conn.cursor()
+            cursor.copy_expert(TRAFFIC_LOG_COPY, buf)
+            execute_values(cursor, TRAFFIC_ROLLUP_UPSERT, rollups)
+            conn.commit()
+        except Exception as e:
+            print(f"[!] DB Writer Error: dropped {len(rows)} rows: {e}")
+            if conn is not None:
+                try:
+                    conn.rollback()
+                except Exception:
+                    pass
+        finally:
+            if conn is not None:
+                conn.close()
+
+def db_writer_thread():
+    """Drains queued traffic rows every 50 ms or 1000 rows, whichever comes first."""
+    while True:
+        rows = [pending_logs.get()]
+        deadline = time.monotonic() + WRITER_FLUSH_INTERVAL
+        while len(rows) < WRITER_BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
             try:
-                # Upsert logic for network agents
-                agent = db.query(Agent).filter(Agent.ip_address == agent_ip).first()
-                if not agent:
-                    worker_name = config.get_agent_name(agent_ip)
-                    agent = Agent(ip_address=agent_ip, mac_address=payload.get("mac", "Unknown"), name=f"Agent_{worker_name}")
-                    db.add(agent)
-                    db.commit()
-                    db.refresh(agent)
-
-                # Map incoming payload to database schema
-                target_ip = payload.get("destination_ip")
-                traffic = TrafficLog(
-                    agent_id=agent.id, direction=payload.get("direction"),
-                    destination_ip=target_ip, port=payload.get("port"),
-                    size_bytes=payload.get("size_bytes"), country=payload.get("country"),
-                    software_name=payload.get("software_name")
-                )
-                db.add(traffic)
-
-                # Threat Detection: Blacklist matching
-                if traffic.direction == "out" and target_ip in config.get_blacklist():
-                    db.add(BlacklistAlert(agent_id=agent.id, destination_ip=target_ip))
-                    payload["alert"] = True
-                
-                # Threat Detection: Port scanning
-                if detect_port_scan(agent_ip, target_ip, payload.get("port")):
-                    db.add(BlacklistAlert(agent_id=agent.id, destination_ip=f"PORT SCAN: {target_ip}"))
-                    payload["security_event"] = "Port Scan Detected"
-                    payload["alert"] = True
+                rows.append(pending_logs.get(timeout=remaining))
+            except queue.Empty:
+                break
+        try:
+            copy_traffic_logs(rows)
+        except Exception as e:
+            # Never let one bad batch stop logging for good
+            print(f"[!] DB Writer Error: dropped {len(rows)} rows: {e}")
 
-                db.commit()
-                payload["agent_id"] = agent.id
-                
-                # Offload WebSocket broadcasting to the main async loop
-                if main_loop:
-                    asyncio.run_coroutine_threadsafe(broadcast_packet(payload), main_loop)
-            except Exception as e:
-                print(f"[!] DB Handler Error: {e}")
-                db.rollback()
-            finally:
-                db.close()
+# Column limits for telemetry fields (port is an Integer, size_bytes a BigInteger)
+MAX_PORT = 65535
+MAX_SIZE_BYTES = 2 ** 63 - 1
+MAX_TS_NS = 2 ** 63 - 1
+# Agent timestamps further than this from the receive time are replaced by it
+MAX_CLOCK_SKEW_NS = 24 * 3600 * 10 ** 9
+
+def coerce_int(value, upper):
+    """Returns value as an int within [0, upper], None when absent; raises ValueError otherwise."""
+    if value is None:
+        return None
+    number = int(value)
+    if not 0 <= number <= upper:
+        raise ValueError(f"{number} out of range")
+    return number
+
+def coerce_label(value):
+    """Returns value as a COPY-safe string, None when absent."""
+    if value is None:
+        return None
+    return str(value).replace("\x00", "")
+
+def handle_datagram(raw_data, agent_ip, scan_detector):
+    """Backend handler for one raw UDP datagram sent by a network agent."""
+    try:
+        payload = orjson.loads(raw_data)
+        # The port is open to anyone: reject malformed fields before they reach the writer
+        port = coerce_int(payload.get("port"), MAX_PORT)
+        size_bytes = coerce_int(payload.get("size_bytes"), MAX_SIZE_BYTES)
+        # Agents stamp packets with integer epoch nanoseconds; older agents send none
+        try:
+            ts_ns = coerce_int(payload.get("ts_ns"), MAX_TS_NS)
+        except ValueError:
+            ts_ns = None  # Unusable timestamp: fall back to the receive time
+        target_ip = coerce_label(payload.get("destination_ip"))
+        direction = coerce_label(payload.get("direction"))
+        country = coerce_label(payload.get("country"))
+        software_name = coerce_label(payload.get("software_name"))
+        mac_address = coerce_label(payload.get("mac", "Unknown"))
+    except: return
+
+    try:
+        agent_id, generation = resolve_agent_id(agent_ip, mac_address)
+
+        # Map incoming payload to the traffic_logs column order and hand it to the writer
+        now_ns = time.time_ns()
+        if ts_ns is None or abs(ts_ns - now_ns) > MAX_CLOCK_SKEW_NS:
+            ts_ns = now_ns
+        timestamp = datetime.fromtimestamp(ts_ns / 1e9, timezone.utc)
+        try:
+            pending_logs.put_nowait((generation, (
+                agent_id, timestamp, direction,
+                target_ip, port, size_bytes, country, software_name
+            )))
+        except queue.Full:
+            pass  # The writer is falling behind; shed load rather than grow without bound
+
+        alerts = []
+        # Threat Detection: Blacklist matching
+        if direction == "out" and config.is_blacklisted(target_ip):
+            alerts.append(BlacklistAlert(agent_id=agent_id, destination_ip=target_ip))
+            payload["alert"] = True
+
+        # Threat Detection: Port scanning
+        scan_detector.sync(generation)
+        if scan_detector.detect(agent_ip, target_ip, port):
+            alerts.append(BlacklistAlert(agent_id=agent_id, destination_ip=f"PORT SCAN: {target_ip}"))
+            payload["security_event"] = "Port Scan Detected"
+            payload["alert"] = True
+
+        # Alerts are rare, so they still go through the ORM directly
+        if alerts:
+            with db_lock:
+                if generation == db_generation:
+                    db = SessionLocal()
+                    try:
+                        db.add_all(alerts)
+                        db.commit()
+                    except Exception:
+                        db.rollback()
+                        raise
+                    finally:
+                        db.close()
+
+        payload["agent_id"] = agent_id
+
+        # Offload WebSocket broadcasting to the main async loop
+        if main_loop and active_connections:
+            message = orjson.dumps(payload).decode('utf-8')
+            main_loop.call_soon_threadsafe(broadcast_packet, message)
+    except Exception as e:
+        print(f"[!] DB Handler Error: {e}")
+
+def open_udp_socket():
+    """Binds one listener socket; with SO_REUSEPORT several can share the port."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    # A large receive buffer absorbs agent bursts instead of dropping datagrams
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, UDP_RCVBUF_BYTES)
+    if hasattr(socket, "SO_REUSEPORT"):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((LISTEN_IP, LISTEN_PORT))
+    return sock
+
+def start_ingestion():
+    """Starts the bulk writer and one UDP receive worker (with its own scan detector) per socket."""
+    threading.Thread(target=db_writer_thread, daemon=True).start()
+    for _ in range(UDP_WORKERS):
+        threading.Thread(target=udp_worker_thread, args=(open_udp_socket(), PortScanDetector()), daemon=True).start()
+
+def udp_worker_thread(sock, scan_detector):
+    """Receive loop for one listener socket, reusing a single datagram buffer."""
+    buf = bytearray(UDP_MAX_DATAGRAM)
+    view = memoryview(buf)
+    while True:
+        try:
+            nbytes, (agent_ip, _) = sock.recvfrom_into(buf)
+        except OSError as e:
+            print(f"[!] UDP Receive Error: {e}")
+            continue
+        handle_datagram(view[:nbytes], agent_ip, scan_detector)
 
 # --- REST API Endpoints ---
 
@@ -145,10 +408,7 @@ async def get_agents():
 async def get_stats(agent_id: str, timeframe: str = "all"):
     db = SessionLocal()
     try:
-        query = db.query(TrafficLog)
-        if agent_id != "all":
-            query = query.filter(TrafficLog.agent_id == int(agent_id))
-        
+        since = None
         if timeframe != "all":
             now = datetime.now(timezone.utc)
             offsets = {
@@ -161,13 +421,26 @@ async def get_stats(agent_id: str, timeframe: str = "all"):
                 "1y": timedelta(days=365)
             }
             if timeframe in offsets:
-                query = query.filter(TrafficLog.timestamp >= now - offsets[timeframe])
+                # Resolution is one rollup bucket: the bucket containing the cutoff is included
+                since = rollup_bucket(now - offsets[timeframe])
+
+        def totals(dimension):
+            """Sums pre-aggregated packet/byte counters per label for one dimension."""
+            packets = func.sum(TrafficRollup.packets)
+            query = db.query(TrafficRollup.label, packets, func.sum(TrafficRollup.bytes)).filter(TrafficRollup.dimension == dimension)
+            if agent_id != "all":
+                query = query.filter(TrafficRollup.agent_id == int(agent_id))
+            if since is not None:
+                query = query.filter(TrafficRollup.bucket >= since)
+            return query.group_by(TrafficRollup.label).order_by(packets.desc())
 
-        countries = [{"label": r[0], "value": r[1]} for r in query.with_entities(TrafficLog.country, func.count(TrafficLog.id)).group_by(TrafficLog.country).all()]
-        softwares = [{"label": r[0], "value": r[1]} for r in query.with_entities(TrafficLog.software_name, func.count(TrafficLog.id)).group_by(TrafficLog.software_name).all()]
-        ips = [{"label": r[0], "value": r[1]} for r in query.with_entities(TrafficLog.destination_ip, func.count(TrafficLog.id)).group_by(TrafficLog.destination_ip).order_by(func.count(TrafficLog.id).desc()).limit(10).all()]
-        bandwidth = [{"label": r[0], "value": round(r[1] / (1024 * 1024), 2)} for r in query.with_entities(TrafficLog.software_name, func.sum(TrafficLog.size_bytes)).group_by(TrafficLog.software_name).order_by(func.sum(TrafficLog.size_bytes).desc()).limit(5).all() if r[1]]
-        top_processes = [{"name": r[0], "count": r[1]} for r in query.with_entities(TrafficLog.software_name, func.count(TrafficLog.id)).group_by(TrafficLog.software_name).order_by(func.count(TrafficLog.id).desc()).limit(10).all()]
+        software_rows = [(r[0], int(r[1]), int(r[2])) for r in totals("software").all()]
+
+        countries = [{"label": r[0], "value": int(r[1])} for r in totals("country").all()]
+        softwares = [{"label": name, "value": count} for name, count, _ in software_rows]
+        ips = [{"label": r[0], "value": int(r[1])} for r in totals("ip").limit(10).all()]
+        bandwidth = [{"label": name, "value": round(size / (1024 * 1024), 2)} for name, _, size in sorted(software_rows, key=lambda r: r[2], reverse=True)[:5] if size]
+        top_processes = [{"name": name, "count": count} for name, count, _ in software_rows[:10]]
 
         return {
             "countries": countries, "softwares": softwares,
@@ -180,13 +453,23 @@ async def get_stats(agent_id: str, timeframe: str = "all"):
 async def reset_db():
     # Define the sync reset function to run in executor
     def perform_reset():
+        global db_generation
         with db_lock: # Lock the DB while we truncate
             db = SessionLocal()
             try:
-                db.execute(text("TRUNCATE TABLE blacklist_alerts, traffic_logs, agents RESTART IDENTITY CASCADE;"))
+                db.execute(text("TRUNCATE TABLE blacklist_alerts, traffic_rollups, traffic_logs, agents RESTART IDENTITY CASCADE;"))
                 db.commit()
-                port_scan_tracker.clear()
-                last_alert_time.clear()
+                # Rows queued before the reset reference agents that no longer exist.
+                # Clear the cache before bumping the generation (see resolve_agent_id);
+                # anything still in flight is discarded by its stale generation, and each
+                # UDP worker resets its own scan detector when it sees the new one.
+                agent_id_cache.clear()
+                db_generation += 1
+                try:
+                    while True:
+                        pending_logs.get_nowait()
+                except queue.Empty:
+                    pass
             finally:
                 db.close()
 
@@ -202,18 +485,21 @@ async def reset_db():
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
     await websocket.accept()
-    active_connections.append(websocket)
+    outbox = asyncio.Queue(maxsize=WS_QUEUE_SIZE)
+    writer = asyncio.create_task(websocket_writer(websocket, outbox))
+    active_connections[websocket] = outbox
     try:
         while True: 
             await websocket.receive_text()
     except WebSocketDisconnect:
-        active_connections.remove(websocket)
+        pass
+    finally:
+        active_connections.pop(websocket, None)
+        writer.cancel()
 
 if __name__ == "__main__":
     if sys.platform == 'win32':
         asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
-        
-    threading.Thread(target=lambda: socketserver.ThreadingUDPServer((LISTEN_IP, LISTEN_PORT), UDPDataHandler).serve_forever(), daemon=True).start()
     
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000, log_level="error")
\ No newline at end of file